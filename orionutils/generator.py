@@ -1,24 +1,167 @@
 """Utilities for generating collections which can be built and published."""
 
+import collections
+import concurrent.futures
+import functools
+import io
+import json
 import logging
 import os
 import random
 import re
-import shutil
 import string
 import subprocess
+import tarfile
 import tempfile
+import threading
 
 import attr
 import yaml
 
-from typing import Callable
-
+from typing import Callable, List
 
 logger = logging.getLogger(__name__)
 
+# Prefer the libyaml C bindings when PyYAML was built with them.
+CLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+CDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# Load a trivial document at import so the first build does not pay libyaml's setup cost
+yaml.load("a: 1", Loader=CLoader)
+
+_ALPHA = string.ascii_lowercase.encode("ascii")
+
+_COLLECTIONS_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "collections")
+_KITCHENSINK_DIR = os.path.join(_COLLECTIONS_DIR, "kitchensink")
+
+_TARBALL_RE = re.compile(r"([-_/\w.]+\.tar\.gz)")
+_GALAXY_NAME_RE = re.compile(r"^name:.*$", re.M)
+
+
+@functools.lru_cache(maxsize=128)
+def _read_placeholder(src):
+    """Read and cache the bytes of a placeholder file, keyed by its absolute path."""
+
+    with open(src, "rb") as f:
+        return f.read()
+
+
+def _scan_tree(src, prefix=""):
+    for entry in os.scandir(src):
+        relpath = os.path.join(prefix, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            yield relpath, None
+            yield from _scan_tree(entry.path, relpath)
+        else:
+            yield relpath, _read_placeholder(entry.path)
+
+
+@functools.lru_cache(maxsize=128)
+def _read_placeholder_tree(src):
+    """Read and cache a placeholder directory as a tuple of (relpath, bytes) pairs.
+
+    Directories come before their contents and have None in place of bytes, so empty
+    directories are reproduced as well.
+    """
+
+    return tuple(_scan_tree(src))
+
+
+@functools.lru_cache(maxsize=None)
+def _template_snapshot(base):
+    """Archive a collection template into an in-memory tarball the first time it is used."""
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        tar.add(os.path.join(_COLLECTIONS_DIR, base), arcname=".")
+    return buf.getvalue()
+
+
+def _extract_template(base, dest):
+    os.makedirs(dest)
+    with tarfile.open(fileobj=io.BytesIO(_template_snapshot(base))) as tar:
+        if hasattr(tarfile, "fully_trusted_filter"):
+            # The snapshot is built from our own templates, extract it as is
+            tar.extractall(dest, filter="fully_trusted")
+        else:
+            tar.extractall(dest)
+
+
+_quiet = threading.local()
+
+
+class _QuietDisplay:
+    """Wrap ansible's Display so messages from our own builds are logged instead of printed.
+
+    Only the thread running build_collection is silenced, other callers of the display are
+    passed through unchanged.
+    """
+
+    def __init__(self, display):
+        self._display = display
+
+    def display(self, msg, *args, **kwargs):
+        if getattr(_quiet, "active", False):
+            logger.debug(msg)
+        else:
+            self._display.display(msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        if getattr(_quiet, "active", False):
+            logger.warning(msg)
+        else:
+            self._display.warning(msg, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._display, name)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_galaxy_build():
+    """Import ansible's collection builder on first use, or return None if ansible is unusable."""
+
+    try:
+        from ansible.galaxy import collection
+    except Exception:
+        logger.info("Unable to import ansible, using the ansible-galaxy CLI", exc_info=True)
+        return None
+    display = getattr(collection, "display", None)
+    if display is not None and not isinstance(display, _QuietDisplay):
+        collection.display = _QuietDisplay(display)
+    return collection.build_collection
+
+
+def _dump_yaml(data, f):
+    """Write data to a YAML file, emitting JSON when possible since it is much cheaper."""
+
+    try:
+        text = json.dumps(data, indent=2, ensure_ascii=False, allow_nan=False)
+    except (TypeError, ValueError):
+        # Not representable as JSON (dates, sets, NaN, ...), let PyYAML handle it
+        yaml.dump(data, f, Dumper=CDumper)
+    else:
+        f.write(text + "\n")
+
+
+def _make_build_root():
+    """Create a temporary build directory, on tmpfs unless a temp dir was configured."""
+
+    if not any(os.environ.get(var) for var in ("TMPDIR", "TEMP", "TMP")):
+        if os.path.isdir("/dev/shm"):
+            try:
+                return tempfile.mkdtemp(prefix="orion-utils-", dir="/dev/shm")
+            except OSError:
+                logger.info("Unable to create a build directory in /dev/shm, using default")
+    return tempfile.mkdtemp(prefix="orion-utils-")
+
+
+def _write_file(dest, data):
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with open(dest, "wb") as f:
+        f.write(data)
 
-@attr.s
+
+@attr.s(slots=True)
 class CollectionSetup:
     """Helper fills a new collection with content before being built.
 
@@ -38,15 +181,27 @@ class CollectionSetup:
 
     contents = attr.ib(factory=dict)
 
+    # Set when the setup is called for a collection being generated
+    name = attr.ib(default=None, init=False)
+    key = attr.ib(default=None, init=False)
+    checkout = attr.ib(default=None, init=False)
+
     def copy(self, src, dest):
         """Copy from the "kichensink" collection to a new collection being generated."""
 
-        src = os.path.join(os.path.dirname(__file__), "collections", "kitchensink", src)
+        src = os.path.join(_KITCHENSINK_DIR, src)
         dest = os.path.join(self.checkout, dest)
         if os.path.isdir(src):
-            shutil.copytree(src, dest)
+            os.makedirs(dest)
+            for relpath, data in _read_placeholder_tree(src):
+                path = os.path.join(dest, relpath)
+                if data is None:
+                    os.mkdir(path)
+                else:
+                    with open(path, "wb") as f:
+                        f.write(data)
         else:
-            shutil.copy(src, dest)
+            _write_file(dest, _read_placeholder(src))
         return dest
 
     def setup(self, kind, cfg, path):
@@ -60,22 +215,19 @@ class CollectionSetup:
         """Run setup of a role within a collection."""
 
         if cfg and cfg.get("meta"):
-            with open(os.path.join(path, "meta", "main.yml"), "r") as f:
-                loaded_cfg = yaml.safe_load(f)
+            with open(os.path.join(path, "meta", "main.yml"), "r", encoding="utf8") as f:
+                loaded_cfg = yaml.load(f, Loader=CLoader)
             loaded_cfg["galaxy_info"] = cfg["meta"]
-            with open(os.path.join(path, "meta", "main.yml"), "w") as f:
-                yaml.dump(loaded_cfg, f)
+            with open(os.path.join(path, "meta", "main.yml"), "w", encoding="utf8") as f:
+                _dump_yaml(loaded_cfg, f)
 
     def setup_plugins(self, cfg, path):
         """Run setup of a plugin within a collection, writing its documentation and"""
 
         if cfg:
+            body = "\n".join(f"{key}: {value}" for key, value in cfg.items())
             with open(path, "w") as f:
-                print("DOCUMENTATION='''", file=f)
-                print("---", file=f)
-                for key in cfg:
-                    print(f"{key}: {cfg[key]}", file=f)
-                print("'''", file=f)
+                f.write(f"DOCUMENTATION='''\n---\n{body}\n'''\n")
 
     def __call__(self, name, key, checkout):
         """Create a new collection, populating it with configured contents."""
@@ -101,7 +253,7 @@ class CollectionSetup:
             self.contents.setdefault(kind, []).append(filename)
 
 
-@attr.s
+@attr.s(slots=True, frozen=True)
 class UpdateScenario:
     """A pair of CollectionSetup objects and the resulting expected information."""
 
@@ -114,7 +266,7 @@ class UpdateScenario:
     expect_readme = attr.ib(default=None)
 
 
-@attr.s
+@attr.s(slots=True, frozen=True)
 class ContentCard:
     """Expected values for a content card on a collection detail page."""
 
@@ -124,7 +276,8 @@ class ContentCard:
     plugin_type = attr.ib(default=None)
 
 
-@attr.s
+# Not frozen, since callers flip published once the artifact is uploaded
+@attr.s(slots=True)
 class CollectionArtifact:
     """Expected properties for a collection artifact to assert against."""
 
@@ -134,6 +287,7 @@ class CollectionArtifact:
     filename = attr.ib()
     version = attr.ib()
     published = attr.ib(default=False)
+    build_root = attr.ib(default=None)
 
 
 def randstr(length=8, seed=None):
@@ -143,8 +297,10 @@ def randstr(length=8, seed=None):
     :param seed: (default: None) seed to control the generated names.
     """
 
+    if seed is None:
+        return bytes(_ALPHA[b % len(_ALPHA)] for b in os.urandom(length)).decode("ascii")
     r = random.Random(seed)
-    return "".join(r.choice(string.ascii_lowercase) for i in range(length))
+    return "".join(r.choices(string.ascii_lowercase, k=length))
 
 
 def build_collection(
@@ -167,9 +323,12 @@ def build_collection(
                    in the CollectionArtifact object.
         pre_build (Callable): A function to call with name,key,checkout before starting the build
         extra_files (dict): A map of extra filenames and their yaml serializable content to create.
+                            String content is written to the file verbatim.
 
     Returns:
-        artifact (CollectionArtifact): The data object defining the resulting filepath.
+        artifact (CollectionArtifact): The data object defining the resulting filepath. Its
+                                       build_root is the temporary directory holding the build,
+                                       which callers may remove once done with the artifact.
 
     Possible base values:
         collection_dep_a
@@ -188,6 +347,7 @@ def build_collection(
     # TODO: Cleanup confusing three different names of "config"
 
     galaxy_yaml_fn = None
+    build_root = None
     checkout = None
     config = {} if config is None else config
     name = None
@@ -195,13 +355,13 @@ def build_collection(
     if key != "":  # explicitly no key
         key = key or randstr(8)
 
-        source_path = os.path.join(os.path.dirname(__file__), "collections", base)
+        source_path = os.path.join(_COLLECTIONS_DIR, base)
         assert os.path.exists(source_path), f"{source_path} does not exist."
-        build_root = tempfile.mkdtemp(prefix='orion-utils-')
+        build_root = _make_build_root()
         collections_path = os.path.join(build_root, "collections")
         os.makedirs(collections_path)
         checkout = os.path.join(collections_path, base)
-        shutil.copytree(source_path, checkout)
+        _extract_template(base, checkout)
         galaxy_yaml_fn = os.path.join(checkout, "galaxy.yml")
         name = base.replace("-", "_")
 
@@ -213,7 +373,8 @@ def build_collection(
     # Update the configuration of the collection
     if galaxy_yaml_fn and os.path.exists(galaxy_yaml_fn):
         with open(galaxy_yaml_fn) as f:
-            cfg = yaml.safe_load(f)
+            text = f.read()
+        cfg = yaml.load(text, Loader=CLoader)
         if key:
             name = f'{cfg["name"]}_{key}'
         if config:
@@ -226,25 +387,93 @@ def build_collection(
         if not isinstance(cfg["version"], str):
             raise ValueError("version must be a string")
 
+        count = 0
+        if not config:
+            # Only the name changed, so rewrite that line rather than re-emitting the file
+            name_line = f"name: {json.dumps(name, ensure_ascii=False)}"
+            text, count = _GALAXY_NAME_RE.subn(lambda m: name_line, text, 1)
+
         with open(galaxy_yaml_fn, "w", encoding="utf8") as f:
-            yaml.dump(cfg, f)
+            if count:
+                f.write(text)
+            else:
+                _dump_yaml(cfg, f)
 
     if extra_files:
-        for filename in extra_files:
-            dirpath = os.path.join(checkout, os.path.dirname(filename))
-            filepath = os.path.join(checkout, filename)
-            os.makedirs(dirpath, exist_ok=True)
-            with open(filepath, 'w', encoding='utf8') as f:
-                yaml.dump(extra_files[filename], f)
+        # Group files by directory so each directory is only created once
+        groups = collections.defaultdict(list)
+        for filename, content in extra_files.items():
+            groups[os.path.dirname(filename)].append((filename, content))
+
+        for dirname, items in groups.items():
+            os.makedirs(os.path.join(checkout, dirname), exist_ok=True)
+            for filename, content in items:
+                with open(os.path.join(checkout, filename), 'w', encoding='utf8') as f:
+                    if isinstance(content, str):
+                        f.write(content if content.endswith("\n") else content + "\n")
+                    else:
+                        yaml.dump(content, f, Dumper=CDumper)
 
     logger.info(f"Building collection {name} at {checkout}")
-    cmd_str = "ansible-galaxy collection build -vvv"
-    p = subprocess.run(
-        cmd_str, cwd=checkout, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    filename = None
+    galaxy_build = _load_galaxy_build()
+    if galaxy_build is not None:
+        # ansible's Display reports the artifact on stdout, keep that out of the caller's output
+        _quiet.active = True
+        try:
+            filename = galaxy_build(checkout, checkout, True)
+        finally:
+            _quiet.active = False
+        if not filename:
+            # Older ansible releases do not return the artifact path
+            filename = os.path.join(
+                checkout, f'{cfg["namespace"]}-{cfg["name"]}-{cfg["version"]}.tar.gz'
+            )
+    else:
+        # Ansible is not importable from this interpreter, shell out to the CLI instead
+        cmd = ["ansible-galaxy", "collection", "build", "-v"]
+        m = None
+        tail = collections.deque(maxlen=50)
+        with subprocess.Popen(
+            cmd, cwd=checkout, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        ) as p:
+            # Stop reading as soon as the artifact path is reported
+            for line in p.stdout:
+                line = line.decode('utf8', 'replace')
+                tail.append(line)
+                m = _TARBALL_RE.search(line)
+                if m:
+                    break
+        assert m, "".join(tail)
+        filename = m.groups()[0]
+    assert os.path.exists(filename), f"{filename} does not exist."
+    return CollectionArtifact(
+        key, cfg["namespace"], name, filename, cfg["version"], build_root=build_root
     )
-    stdout = p.stdout.decode('utf8')
-    m = re.search(r"([-_/\w\d\.]+\.tar\.gz)", stdout)
-    assert m, stdout
-    filename = m.groups()[0]
-    assert os.path.exists(filename)
-    return CollectionArtifact(key, cfg["namespace"], name, filename, cfg["version"])
+
+
+def build_collections(specs: List[dict]) -> List[CollectionArtifact]:
+    """Build several collections in parallel and return their CollectionArtifacts
+
+    Each build runs in its own worker process and checks out into its own directory created by
+    tempfile.mkdtemp, so builds do not share any state.
+
+    Args:
+        specs (list): A list of keyword argument maps, one per call to build_collection.
+
+    Returns:
+        artifacts (list): The CollectionArtifact for each spec, in the same order as specs.
+
+    Notes:
+        Every value in a spec must be picklable, so pre_build callbacks have to be module level
+        functions or CollectionSetup instances. A CollectionSetup runs in the worker process, so
+        its contents attribute is not updated in the caller.
+    """
+
+    if not specs:
+        return []
+
+    max_workers = min(len(specs), os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(build_collection, **spec) for spec in specs]
+        return [future.result() for future in futures]
@@ -1,9 +1,31 @@
+import builtins
+import datetime
 import json
 import os
+import shutil
+import string
 import tarfile
+import tempfile
 import pytest
+import yaml
 import orionutils
-from orionutils.generator import build_collection
+from orionutils import generator
+from orionutils.generator import build_collection, build_collections, CollectionSetup, randstr
+
+
+@pytest.fixture(autouse=True)
+def cleanup_build_roots(monkeypatch):
+    build_roots = []
+    make_build_root = generator._make_build_root
+
+    def tracking_make_build_root():
+        build_roots.append(make_build_root())
+        return build_roots[-1]
+
+    monkeypatch.setattr(generator, "_make_build_root", tracking_make_build_root)
+    yield
+    for build_root in build_roots:
+        shutil.rmtree(build_root, ignore_errors=True)
 
 
 def artifact_peek(filename):
@@ -17,12 +39,13 @@ def artifact_peek(filename):
     return fmap
 
 
-def test_build_collection_skeleton():
+def test_build_collection_skeleton(capsys):
     artifact = build_collection("skeleton")
     assert artifact is not None
     assert os.path.exists(artifact.filename)
     install_path = os.path.dirname(orionutils.__file__)
     assert not artifact.filename.startswith(install_path)
+    assert capsys.readouterr().out == ""
 
 
 def test_build_collection_skeleton_with_key():
@@ -55,6 +78,23 @@ def test_build_collection_skeleton_with_namespace_name_version():
     assert meta["collection_info"]["version"] == "5.5.5"
 
 
+def test_build_collection_skeleton_with_non_bmp_description():
+    description = "caf\u00e9 \U0001F600"
+    artifact = build_collection(
+        "skeleton", config={"description": description, "version": "1.2.3"}
+    )
+    fmap = artifact_peek(artifact.filename)
+    meta = json.loads(fmap["MANIFEST.json"])
+    assert meta["collection_info"]["description"] == description
+
+
+def test_build_collection_skeleton_with_non_json_config():
+    artifact = build_collection(
+        "skeleton", config={"version": "1.2.3", "build_date": datetime.date(2020, 1, 1)}
+    )
+    assert os.path.exists(artifact.filename)
+
+
 def test_build_collection_skeleton_with_prebuild():
 
     def this_prebuild(name, key, checkout):
@@ -73,12 +113,135 @@ def test_build_collection_skeleton_with_prebuild():
 
 
 def test_build_collection_skeleton_with_extra_files():
-    artifact = build_collection("skeleton", extra_files={"roles/foobar/main.yml": "# a role"})
+    artifact = build_collection("skeleton", extra_files={
+        "roles/foobar/main.yml": "# a role",
+        "roles/foobar/meta/main.yml": {"galaxy_info": {"author": "foo"}},
+    })
     fmap = artifact_peek(artifact.filename)
-    assert "roles/foobar/main.yml" in fmap
+    assert fmap["roles/foobar/main.yml"] == b"# a role\n"
+    assert yaml.safe_load(fmap["roles/foobar/meta/main.yml"]) == {"galaxy_info": {"author": "foo"}}
 
 
 def test_build_collection_skeleton_with_integer_version():
     with pytest.raises(ValueError) as excinfo:
         build_collection("skeleton", config={"version": 3})
     assert str(excinfo.value) == "version must be a string"
+
+
+def test_build_collection_skeleton_with_collection_setup():
+    setup = CollectionSetup({
+        "plugins/modules/fakemod.py": {"short_description": "A fake module"},
+        "roles/fakerole": {"meta": {"description": "This role is a fake role."}},
+    })
+    artifact = build_collection("skeleton", pre_build=setup)
+    fmap = artifact_peek(artifact.filename)
+    assert "plugins/modules/fakemod.py" in fmap
+    assert "roles/fakerole/tasks/main.yml" in fmap
+    assert b"short_description: A fake module" in fmap["plugins/modules/fakemod.py"]
+    assert setup.contents == {"plugins": ["fakemod.py"], "roles": ["fakerole"]}
+
+    role_meta = yaml.safe_load(fmap["roles/fakerole/meta/main.yml"])
+    assert role_meta["galaxy_info"] == {"description": "This role is a fake role."}
+
+
+def test_build_collection_skeleton_with_non_ascii_role_meta():
+    description = "R\u00f4le de d\u00e9monstration \U0001F600"
+    setup = CollectionSetup({"roles/fakerole": {"meta": {"description": description}}})
+    artifact = build_collection("skeleton", pre_build=setup)
+    fmap = artifact_peek(artifact.filename)
+    role_meta = yaml.safe_load(fmap["roles/fakerole/meta/main.yml"].decode("utf8"))
+    assert role_meta["galaxy_info"] == {"description": description}
+
+
+def test_build_collection_skeleton_with_cli_fallback(monkeypatch):
+    monkeypatch.setattr(generator, "_load_galaxy_build", lambda: None)
+    artifact = build_collection("skeleton", key="foobar")
+    assert os.path.exists(artifact.filename)
+    assert artifact.name.endswith("_foobar")
+
+
+def test_build_collection_skeleton_with_no_galaxy_build_result(monkeypatch):
+    galaxy_build = generator._load_galaxy_build()
+
+    def old_galaxy_build(collection_path, output_path, force):
+        galaxy_build(collection_path, output_path, force)
+
+    monkeypatch.setattr(generator, "_load_galaxy_build", lambda: old_galaxy_build)
+    artifact = build_collection("skeleton", key="foobar")
+    assert os.path.exists(artifact.filename)
+    assert os.path.basename(artifact.filename) == "orionuser1-collection_dep_a_foobar-1.0.0.tar.gz"
+
+
+def test_build_collection_leaves_other_display_output(capsys):
+    build_collection("skeleton")
+    from ansible.galaxy import collection
+    collection.display.display("not from a build")
+    assert capsys.readouterr().out == "not from a build\n"
+
+
+def test_load_galaxy_build_with_broken_ansible(monkeypatch):
+    real_import = builtins.__import__
+
+    def broken_import(name, *args, **kwargs):
+        if name.startswith("ansible"):
+            raise RuntimeError("broken ansible configuration")
+        return real_import(name, *args, **kwargs)
+
+    generator._load_galaxy_build.cache_clear()
+    monkeypatch.setattr(builtins, "__import__", broken_import)
+    try:
+        assert generator._load_galaxy_build() is None
+    finally:
+        generator._load_galaxy_build.cache_clear()
+
+
+def test_build_collections():
+    artifacts = build_collections([
+        {"base": "skeleton", "key": "foo"},
+        {"base": "skeleton", "key": "bar", "config": {"version": "2.0.0"}},
+    ])
+    assert [artifact.key for artifact in artifacts] == ["foo", "bar"]
+    assert artifacts[1].version == "2.0.0"
+    for artifact in artifacts:
+        assert os.path.exists(artifact.filename)
+        # Built in worker processes, so not tracked by cleanup_build_roots
+        shutil.rmtree(artifact.build_root)
+
+
+def test_build_collection_respects_tmpdir(monkeypatch, tmp_path):
+    monkeypatch.setenv("TMPDIR", str(tmp_path))
+    monkeypatch.setattr(tempfile, "tempdir", None)
+    artifact = build_collection("skeleton")
+    assert artifact.build_root.startswith(str(tmp_path))
+
+
+def test_build_collection_tmpfs_fallback(monkeypatch):
+    mkdtemp = tempfile.mkdtemp
+
+    def failing_mkdtemp(prefix=None, dir=None):
+        if dir == "/dev/shm":
+            raise OSError("No space left on device")
+        return mkdtemp(prefix=prefix, dir=dir)
+
+    for var in ("TMPDIR", "TEMP", "TMP"):
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.setattr(tempfile, "mkdtemp", failing_mkdtemp)
+    artifact = build_collection("skeleton")
+    assert not artifact.build_root.startswith("/dev/shm")
+    assert os.path.exists(artifact.filename)
+
+
+def test_randstr():
+    value = randstr()
+    assert len(value) == 8
+    assert set(value) <= set(string.ascii_lowercase)
+    assert len(randstr(16)) == 16
+    assert randstr(seed=1) == randstr(seed=1)
+
+
+def test_build_collection_build_root():
+    artifact = build_collection("skeleton")
+    assert os.path.isdir(artifact.build_root)
+    assert artifact.filename.startswith(artifact.build_root)
+    shutil.rmtree(artifact.build_root)
+    assert not os.path.exists(artifact.filename)
@@ -5,3 +5,7 @@ def test_increment_version():
     v1 = "1.1.1"
     v2 = increment_version(v1)
     assert v2 == "1.1.2"
+
+
+def test_increment_version_four_parts():
+    assert increment_version("1.2.3.9") == "1.2.3.10"